@@ -8,12 +8,49 @@ import xml.etree.ElementTree as Et
 import cleaner
 import time
 import os
+import posixpath
+import re
 import glob
-import snowflake.connector
+import concurrent.futures
+import functools
 import logging
 
 VERSION = '1.0'
 
+# number of PUT commands in flight at once, each PUT also uploads its files in parallel
+PUT_THREADS = 4
+# upload threads per PUT, shared between the PUT commands when they run at the same time
+PUT_PARALLEL = 64
+
+# tool logger plus the connector logger, both written to the log file of the current run
+logger = logging.getLogger('snowflake_ss')
+logger.propagate = False
+LOGGERS = (logger, logging.getLogger('snowflake.connector'))
+
+# characters not allowed in the temp path
+FORBIDDEN_CHARS = re.compile(r'[/;?*"<>|]')
+
+# seconds a temp path write check is reused for, keyed by path
+ACCESS_TTL = 30
+access_cache: dict = {}
+
+
+def is_writable(path: str) -> bool:
+    """
+    Checks the path is writable, reusing a recent result for the same path.
+    :param path: The path to check.
+    :return: True if the path is writable.
+    """
+
+    now = time.monotonic()
+    cached = access_cache.get(path)
+    if cached and now - cached[0] < ACCESS_TTL:
+        return cached[1]
+
+    writable = os.access(path, os.W_OK)
+    access_cache[path] = (now, writable)
+    return writable
+
 
 class AyxPlugin:
     """
@@ -21,6 +58,11 @@ class AyxPlugin:
     Prefixed with "pi", the Alteryx engine will expect the below five interface methods to be defined.
     """
 
+    # Optional text settings and checkbox settings read from the GUI XML
+    STR_KEYS: tuple = ('auth_type', 'okta_url', 'sql_type', 'temp_dir', 'ss_data_field')
+    # attribute name: XML tag
+    BOOL_KEYS: dict = {'case_sensitive': 'case_sensitive', 'suspend_wh': 'supend_wh', 'delete_tempfiles': 'delete_tempfiles'}
+
     def __init__(self, n_tool_id: int, alteryx_engine: object, output_anchor_mgr: object):
         """
         Constructor is called whenever the Alteryx engine wants to instantiate an instance of this plugin.
@@ -38,7 +80,7 @@ class AyxPlugin:
 
         # Create text box variables
         for item in self.input_list:
-            setattr(AyxPlugin, item, None)
+            setattr(self, item, None)
 
         self.auth_type: str = None
         self.okta_url: str = None
@@ -46,6 +88,9 @@ class AyxPlugin:
         self.temp_dir: str = None
         self.ss_data_field: str = None
 
+        # ss_data_field as used in SQL, quoted if needed
+        self.column: str = None
+
         self.case_sensitive: bool = False
         self.suspend_wh: bool = False
         self.delete_tempfiles: bool = False
@@ -67,23 +112,24 @@ class AyxPlugin:
         # Getting the user-entered file path string from the GUI, to use as output path.
         root = Et.fromstring(str_xml)
 
-        # Basic text inpiut list
+        # Read all settings in a single pass over the root children
+        cfg: dict = {child.tag: child.text for child in root}
+
+        # Basic text inpiut list, sanitised and checked as it is stored
         for item in self.input_list:
-            setattr(AyxPlugin, item, root.find(item).text if item in str_xml else None)
+            value = cleaner.sanitise_inputs(cfg.get(item))
+            if value is None:
+                self.display_error_msg(f"Enter a valid {item}")
+                return False
+            setattr(self, item, value)
 
-        self.auth_type = root.find('auth_type').text  if 'auth_type' in str_xml else None
-        self.okta_url = root.find('okta_url').text if 'okta_url' in str_xml else None
-        self.temp_dir = root.find('temp_dir').text  if 'temp_dir' in str_xml else None
-        self.sql_type = root.find('sql_type').text  if 'sql_type' in str_xml else None
-        self.ss_data_field = root.find('ss_data_field').text  if 'ss_data_field' in str_xml else None
+        # fix for listrunner sending line feeds and spaces
+        for key in self.STR_KEYS:
+            setattr(self, key, cleaner.sanitise_inputs(cfg.get(key)))
 
-        self.case_sensitive = root.find('case_sensitive').text == 'True' if 'case_sensitive' in str_xml else False
-        self.suspend_wh = root.find('supend_wh').text == 'True' if 'supend_wh' in str_xml else False
+        for attr, key in self.BOOL_KEYS.items():
+            setattr(self, attr, cfg.get(key) == 'True')
 
-        # fix for listrunner sending line feeds and spaces
-        self.okta_url = cleaner.sanitise_inputs(self.okta_url)
-        self.temp_dir = cleaner.sanitise_inputs(self.temp_dir)
-            
         # check for okta url is using okta
         if self.auth_type == 'okta':
             if not self.okta_url:
@@ -93,21 +139,19 @@ class AyxPlugin:
                 self.display_error_msg(f"Supplied Okta URL is not valid")
                 return False        
 
-        # data checks
-        for item in self.input_list:
-            attr = getattr(AyxPlugin, item, None)
-            attr = cleaner.sanitise_inputs(attr)
-            if attr is None:
-                self.display_error_msg(f"Enter a valid {item}")
-                return False
-
         if not self.ss_data_field:
             self.display_error_msg(f'Map a valid filepath to the data files')
+            return False
+
+        # fix table name and field name if case sensitive used or keyswords
+        self.table = cleaner.reserved_words(self.table, self.case_sensitive)
+        self.column = cleaner.reserved_words(self.ss_data_field, self.case_sensitive)
 
         # remove protocol if added
         if '//' in self.account:
             self.account = self.account[self.account.find('//') + 2:]
 
+        # the GUI stores the password reversed, it is read fresh from the XML above so this runs once per pi_init
         self.password = self.password[::-1]
 
         # Check temp_dir and use Alteryx default if None
@@ -115,7 +159,7 @@ class AyxPlugin:
             self.temp_dir = self.alteryx_engine.get_init_var(self.n_tool_id, "TempPath")
             self.display_file(f'{self.temp_dir}| Using system temp dir {self.temp_dir}')
         else:
-            error_msg = self.msg_str(self.temp_dir)
+            error_msg = self.validate_temp_dir(self.temp_dir)
             if error_msg != '':
                 self.display_error_msg(error_msg)
                 return False
@@ -170,21 +214,21 @@ class AyxPlugin:
         self.alteryx_engine.output_message(self.n_tool_id, Sdk.Status.file_output, msg_string)
 
     @staticmethod
-    def msg_str(file_path: str) -> str:
+    def validate_temp_dir(file_path: str) -> str:
         """
-        A non-interface, helper function that handles validating the file path input.
-        :param file_path: The file path and file name input by user.
-        :return: The chosen message string.
+        A non-interface, helper function that handles validating the temp path input, called once from pi_init.
+        The cheap checks run first and the write check reuses a recent result for the same path.
+        :param file_path: The temp path input by user.
+        :return: The error message, or an empty string if the path is valid.
         """
 
-        msg_str = ''
         if len(file_path) > 259:
-            msg_str = 'Maximum path length is 259'
-        elif any((char in set('/;?*"<>|')) for char in file_path):
-            msg_str = 'These characters are not allowed in the file path: /;?*"<>|'
-        elif not os.access(file_path, os.W_OK):
-            msg_str = 'Unable to write to supplied temp path'
-        return msg_str  
+            return 'Maximum path length is 259'
+        if FORBIDDEN_CHARS.search(file_path):
+            return 'These characters are not allowed in the file path: /;?*"<>|'
+        if not is_writable(file_path):
+            return 'Unable to write to supplied temp path'
+        return ''
 
 class IncomingInterface:
     """
@@ -203,11 +247,24 @@ class IncomingInterface:
 
         # Custom membersn
         self.record_info_in = None
-        self.field_list: list = []
         self.counter: int = 0
         self.timestamp: int = 0
         self.fld_index: int = None
 
+        # Snowflake connection, opened in ii_close once all records have arrived
+        self.con: object = None
+        self.cur: object = None
+
+        # paths to upload, file names grouped by directory in the order they arrive
+        self.dirs: dict = {}
+
+        # file extension of the first path and whether any other extension was seen
+        self._ext: str = None
+        self._mixed: bool = False
+
+        # cached per-record accessors, set in ii_init
+        self._get_str = None
+
     def ii_init(self, record_info_in: object) -> bool:
         """
         Handles the storage of the incoming metadata for later use.
@@ -215,9 +272,11 @@ class IncomingInterface:
         :param record_info_in: A RecordInfo object for the incoming connection's fields.
         :return: True for success, otherwise False.
         """
-        field_name: str = ''
-
-        if self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True' or not self.parent.is_initialized:
+        # checked before any setup, the flag first as it needs no call into the engine
+        if not self.parent.is_initialized or self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True':
+            # records are rejected without checking the state on every push, ii_close stops on the flag
+            self.parent.is_initialized = False
+            self.ii_push_record = self._skip_record
             return False
 
         self.parent.display_info(f'Running Snowflake JSON + XML Output version {VERSION}')
@@ -225,15 +284,22 @@ class IncomingInterface:
 
         # Storing the field index of the mapped path
         self.fld_index = record_info_in.get_field_num(self.parent.ss_data_field)
+        self._get_str = record_info_in[self.fld_index].get_as_string
 
         self.timestamp = str(int(time.time()))
         self.parent.temp_dir = os.path.join(self.parent.temp_dir, self.timestamp)
 
-        if not os.path.exists(self.parent.temp_dir):
-            os.makedirs(self.parent.temp_dir)
-        
-        # Logging setup
-        logging.basicConfig(filename=os.path.join(self.parent.temp_dir, 'snowflake_connector.log'), format='%(asctime)s - %(message)s', level=logging.INFO)
+        os.makedirs(self.parent.temp_dir, exist_ok=True)
+
+        # Logging setup, replacing the log file of any previous run
+        handler = logging.FileHandler(os.path.join(self.parent.temp_dir, 'snowflake_connector.log'))
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        for log in LOGGERS:
+            for old_handler in log.handlers[:]:
+                log.removeHandler(old_handler)
+                old_handler.close()
+            log.addHandler(handler)
+            log.setLevel(logging.INFO)
 
         return True
 
@@ -245,16 +311,38 @@ class IncomingInterface:
         :return: False if file path string is invalid, otherwise True.
         """
 
-        if not self.parent.is_initialized:
-            return False
-
-        # store all paths in list
-        in_value = self.record_info_in[self.fld_index].get_as_string(in_record)
+        # store all paths by directory, with forward slashes as used by PUT
+        in_value = self._get_str(in_record)
         if in_value:
-            self.counter += 1 
-            self.field_list.append(in_value)
+            in_value = in_value.replace('\\', '/')
+            self.counter += 1
+
+            # dicts keep the order of the files and drop paths supplied more than once
+            d, name = posixpath.split(in_value)
+            files = self.dirs.get(d)
+            if files is None:
+                files = self.dirs[d] = {}
+            files[name] = None
+
+            # check we only have one file type as the records arrive
+            dot = name.rfind('.')
+            ext = name[dot + 1:] if dot >= 0 else ''
+            if self._ext is None:
+                self._ext = ext
+            elif ext != self._ext:
+                self._mixed = True
 
         return True
+
+    @staticmethod
+    def _skip_record(in_record: object) -> bool:
+        """
+        Replaces ii_push_record when the tool failed to initialise.
+        :param in_record: The data for the incoming record.
+        :return: Always False.
+        """
+
+        return False
       
     def ii_update_progress(self, d_percent: float):
         """
@@ -269,97 +357,190 @@ class IncomingInterface:
         Called when the incoming connection has finished passing all of its records.
         """
 
-        # for filepaths
-        filename: str = ''
-        ext: str = ''
-        unique_exts: set = set()
-
-        if self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True' or not self.parent.is_initialized:
+        # checked before any setup, the flag first as it needs no call into the engine
+        if not self.parent.is_initialized or self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True':
             return False
         elif self.counter == 0:
             self.parent.display_info('No records to process')
             return False
 
+        try:
+            if not self.valid_ext():
+                return False
+
+            self.connect()
+
+            # each complete directory is uploaded by a single PUT where possible
+            self.put(self.put_paths(self.dirs, self._ext))
+            self.dirs.clear()
+
+            self.cur.execute(f"COPY INTO {self.parent.table} FILE_FORMAT = (TYPE={self._ext} COMPRESSION=GZIP) PURGE = TRUE")
+
+            self.parent.display_info(f'Processed {self.counter:,} records')
+            
+            if self.parent.suspend_wh:
+                self.cur.execute(f'alter warehouse {self.parent.warehouse} suspend')
+                self.parent.display_info('Suspended the warehouse')
+
+        except Exception as e:
+            self.display_exception(e)
+        finally:
+            self.close()
+
+        self.parent.display_info('Snowflake transaction complete')
+
+    def display_exception(self, e: Exception):
+        """
+        A non-interface, helper function that logs and reports an error raised while uploading.
+        Errors that do not come from Snowflake, such as a missing connector, have no query details.
+        :param e: The exception raised.
+        """
+
+        logger.error(str(e))
+        if hasattr(e, 'sfqid'):
+            self.parent.display_error_msg(f'Error {e.errno} ({e.sqlstate}): {e.msg} ({e.sfqid})')
+        else:
+            self.parent.display_error_msg(f'Error: {e}')
+
+    def valid_ext(self) -> bool:
+        """
+        A non-interface, helper function that checks all files share one supported file type.
+        :return: True if the file type is valid, otherwise False.
+        """
+
         # check we only have one file type
-        for f in self.field_list:
-            filename, ext = os.path.splitext(f)
-            unique_exts.add(ext[1:])
-        
-        if len(unique_exts) != 1:
+        if self._mixed:
             self.parent.display_error_msg('You may only upload one file type into a table')
             return False
 
-        # get file extension
-        ext = unique_exts.pop()
-
         # check for valid extentions
-        if ext.lower() not in ['json', 'xml', 'parquet', 'avro', 'orc']:
-            self.parent.display_error_msg(f'{ext} is not a supported file type')
+        if self._ext.lower() not in ['json', 'xml', 'parquet', 'avro', 'orc']:
+            self.parent.display_error_msg(f'{self._ext} is not a supported file type')
             return False
 
-        con: snowflake.connector.connection = None
+        return True
+
+    def connect(self):
+        """
+        A non-interface, helper function that opens the Snowflake connection and prepares the table.
+        """
+
+        # imported here as the connector is slow to load and not needed until files are uploaded
+        import snowflake.connector
 
         # Create Snowflake connection
+        if self.parent.auth_type == 'snowflake':
+            self.con = snowflake.connector.connect(
+                                            user=self.parent.user,
+                                            password=self.parent.password,
+                                            account=self.parent.account,
+                                            warehouse=self.parent.warehouse,
+                                            database=self.parent.database,
+                                            schema=self.parent.schema,
+                                            ocsp_fail_open=True
+                                            )
+            self.parent.display_info('Authenticated via Snowflake')
+        else:
+            self.con = snowflake.connector.connect(
+                                            user=self.parent.user,
+                                            password=self.parent.password,
+                                            authenticator=self.parent.okta_url,
+                                            account=self.parent.account,
+                                            warehouse=self.parent.warehouse,
+                                            database=self.parent.database,
+                                            schema=self.parent.schema,
+                                            ocsp_fail_open=True
+                                            )
+            self.parent.display_info('Authenticated via Okta')
+
+        # cursor for all statements except the PUT commands run concurrently, which use their own
+        self.cur = self.con.cursor()
+
+        # Set warehouse and schema
+        prelude: list = [f"USE WAREHOUSE {self.parent.warehouse}",
+                         f"USE SCHEMA {self.parent.database}.{self.parent.schema}"]
+
+        # Table Creation #
+        if self.parent.sql_type == 'create':
+            table_sql: str = f'Create or Replace table {self.parent.table}  ({self.parent.column} VARIANT)'
+            prelude.append(table_sql)
+
+        elif self.parent.sql_type == 'truncate':
+            prelude.append(f'truncate table {self.parent.table}')
+
+        # send the prelude as one multi-statement query, PUT cannot be part of it
+        # the statement count is only allowed for this query, connector 2.4.1 has no num_statements argument
+        self.cur.execute('; '.join(prelude), _statement_params={'MULTI_STATEMENT_COUNT': len(prelude)})
+
+    def put(self, paths: list):
+        """
+        A non-interface, helper function that uploads files to the table stage.
+        :param paths: The paths to use in the PUT commands.
+        """
 
-        try:
-            if self.parent.auth_type == 'snowflake':
-                con = snowflake.connector.connect(
-                                                user=self.parent.user,
-                                                password=self.parent.password,
-                                                account=self.parent.account,
-                                                warehouse=self.parent.warehouse,
-                                                database=self.parent.database,
-                                                schema=self.parent.schema,
-                                                ocsp_fail_open=True
-                                                )
-                self.parent.display_info('Authenticated via Snowflake')
-            else:
-                con = snowflake.connector.connect(
-                                                user=self.parent.user,
-                                                password=self.parent.password,
-                                                authenticator=self.parent.okta_url,
-                                                account=self.parent.account,
-                                                warehouse=self.parent.warehouse,
-                                                database=self.parent.database,
-                                                schema=self.parent.schema,
-                                                ocsp_fail_open=True
-                                                )                
-                self.parent.display_info('Authenticated via Okta')
-
-            # Set warehouse and schema
-            con.cursor().execute(f"USE WAREHOUSE {self.parent.warehouse}")
-            con.cursor().execute(f"USE SCHEMA {self.parent.database}.{self.parent.schema}")
-
-            # fix table name and field name if case sensitive used or keyswords
-            self.parent.table = cleaner.reserved_words(self.parent.table, self.parent.case_sensitive)
-            self.parent.ss_data_field = cleaner.reserved_words(self.parent.ss_data_field, self.parent.case_sensitive)
-        
-            # Execute Table Creation #
-            if self.parent.sql_type == 'create':
-                table_sql: str = f'Create or Replace table {self.parent.table}  ({self.parent.ss_data_field} VARIANT)'
-                con.cursor().execute(table_sql)
-
-            elif self.parent.sql_type == 'truncate':
-                con.cursor().execute(f'truncate table {self.parent.table}')
-
-            for f in self.field_list:
-                f = f.replace('\\', '/')
-                con.cursor().execute(f"PUT 'file://{f}' @%{self.parent.table} PARALLEL=64 OVERWRITE=TRUE")
-            
-            con.cursor().execute(f"COPY INTO {self.parent.table} FILE_FORMAT = (TYPE={ext} COMPRESSION=GZIP) PURGE = TRUE")
+        # keep the total number of upload threads the same when the PUT commands run concurrently
+        parallel: int = PUT_PARALLEL // PUT_THREADS if len(paths) > 1 else PUT_PARALLEL
+        put_sql: list = [f"PUT 'file://{put_path}' @%{self.parent.table} PARALLEL={parallel} OVERWRITE=TRUE"
+                         for put_path in paths]
 
-            self.parent.display_info(f'Processed {self.counter:,} records')
-            
-            if self.parent.suspend_wh:
-                con.cursor().execute(f'alter warehouse {self.parent.warehouse} suspend')
-                self.parent.display_info('Suspended the warehouse')
+        # overlap the round trips of the PUT commands, all must finish before the COPY INTO
+        if len(put_sql) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=PUT_THREADS) as pool:
+                list(pool.map(functools.partial(self.put_file, self.con), put_sql))
+        elif put_sql:
+            self.cur.execute(put_sql[0])
 
-        except Exception as e:
-            logging.error(str(e))
-            self.parent.display_error_msg(f'Error {e.errno} ({e.sqlstate}): {e.msg} ({e.sfqid})')
-        finally:
+    def close(self):
+        """
+        A non-interface, helper function that closes the Snowflake connection if open.
+        """
+
+        if self.cur:
+            self.cur.close()
+            self.cur = None
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    @staticmethod
+    def put_file(con: object, sql: str):
+        """
+        A non-interface, helper function that runs a PUT command on its own cursor.
+        :param con: The Snowflake connection.
+        :param sql: The PUT command.
+        """
 
-            if con:
-                con.close()
+        with con.cursor() as cur:
+            cur.execute(sql)
 
-        self.parent.display_info('Snowflake transaction complete')
\ No newline at end of file
+    @staticmethod
+    def put_paths(dirs: dict, ext: str) -> list:
+        """
+        A non-interface, helper function that builds the paths to upload for each directory.
+        A directory is uploaded with a single wildcard PUT when a wildcard matches exactly the files supplied,
+        trying all files with the extension and then the files sharing the common name prefix.
+        Otherwise each file in that directory gets its own PUT.
+        :param dirs: The file names in each directory.
+        :param ext: The file extension shared by all the files.
+        :return: The list of paths to use in the PUT commands.
+        """
+
+        paths: list = []
+        for d, files in dirs.items():
+            if len(files) > 1 and not any(glob.has_magic(f) for f in files):
+                names: set = {os.path.normcase(f) for f in files}
+                prefixes: list = ['', os.path.commonprefix(list(files))]
+                if not prefixes[1]:
+                    prefixes.pop()
+                for prefix in prefixes:
+                    # only use the wildcard if it would upload the same files as listed,
+                    # the directory is escaped for the local check as it may contain glob characters
+                    if names == {os.path.normcase(os.path.basename(f))
+                                 for f in glob.glob(posixpath.join(glob.escape(d), f'{prefix}*.{ext}'))}:
+                        paths.append(posixpath.join(d, f'{prefix}*.{ext}'))
+                        break
+                else:
+                    paths.extend(posixpath.join(d, f) for f in files)
+            else:
+                paths.extend(posixpath.join(d, f) for f in files)
+        return paths
\ No newline at end of file